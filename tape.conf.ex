@@ -2,3 +2,8 @@
 database_file = informative-name.sqlite
 tape_device = /dev/non-rewinding-tape-device
 ssh_command = ssh user@host -i /home/user/.ssh/unlocked_key
+
+# Additional drives, for "tapeop schedule" and "tapeop -d NAME ...".
+# Each section takes tape_device or emulator_dir.
+#[drive:lto2]
+#tape_device = /dev/another-non-rewinding-tape-device
@@ -33,6 +33,12 @@ TABLE_DEFS = {
         "`file_number` integer",
         "`status` varchar(16)",
         ],
+    'drives': [
+        "`id` integer primary key autoincrement",
+        "`name` varchar(256) unique",
+        "`tape_id` integer unique",
+        "`keep_online` integer not null default 0",
+        ],
 }
 
 defaults = {
@@ -275,9 +281,14 @@ class TapeDB:
         return c.fetchone()[0]
 
     def get_active_tape(self):
+        """Returns (id, name) of the online tape.  Tapes that are
+        online only because they are mounted in a named drive are
+        considered after the tape activated with set_active_tape."""
         c = self.conn.cursor()
-        c.execute('select id,name from tapes '
-                  'where online=1')
+        c.execute('select T.id,T.name from tapes as T '
+                  'left join drives as D on T.id=D.tape_id '
+                  'where T.online=1 '
+                  'order by (D.tape_id is not null and D.keep_online=0), T.id')
         row = c.fetchone()
         if row is None:
             return None, None
@@ -285,11 +296,88 @@ class TapeDB:
 
     def set_active_tape(self, tape_name, commit=True):
         c = self.conn.cursor()
-        c.execute('update tapes set online=0')
+        # Tapes mounted in a drive stay online.
+        c.execute('update tapes set online=0 where id not in '
+                  '(select tape_id from drives where tape_id is not null)')
         c.execute('update tapes set online=1 where name=?', (tape_name,))
+        # Record which mounted tape, if any, stays online after unmount.
+        c.execute('update drives set keep_online=(tape_id in '
+                  '(select id from tapes where name=?))', (tape_name,))
         if commit:
             self.conn.commit()
 
+    # Work with drives.
+    def get_drive_tape(self, drive_name):
+        """Returns (id, name) of the tape mounted in drive_name, or
+        (None, None) if the drive is empty."""
+        c = self.conn.cursor()
+        c.execute('select T.id,T.name from drives as D '
+                  'join tapes as T on D.tape_id=T.id '
+                  'where D.name=?', (drive_name,))
+        row = c.fetchone()
+        if row is None:
+            return None, None
+        return row
+
+    def get_tape_drive(self, tape_id):
+        """Returns the name of the drive tape_id is mounted in, or None."""
+        if isinstance(tape_id, basestring):
+            tape_id = self.get_tape_id(tape_id)
+        c = self.conn.cursor()
+        c.execute('select name from drives where tape_id=?', (tape_id,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_mounted_tapes(self):
+        c = self.conn.cursor()
+        c.execute('select D.name as drive,T.id as tape_id,T.name as tape_name '
+                  'from drives as D join tapes as T on D.tape_id=T.id '
+                  'order by D.name')
+        return [dict([(k,r[k]) for k in ['drive','tape_id','tape_name']]) for r in c]
+
+    def mount_tape(self, drive_name, tape_name):
+        """Bind tape_name to drive_name and mark the tape online.  Any
+        tape previously mounted in the drive is unmounted, and its name
+        is returned (otherwise None).  A tape can only be mounted in one
+        drive at a time."""
+        tape_id = self.get_tape_id(tape_name)
+        c = self.conn.cursor()
+        c.execute('select name from drives where tape_id=? and name!=?',
+                  (tape_id, drive_name))
+        row = c.fetchone()
+        if row is not None:
+            raise RuntimeError, 'Tape %s is already mounted in drive %s' % (
+                tape_name, row[0])
+        old_tape = self.unmount_tape(drive_name, commit=False)
+        c.execute('select online from tapes where id=?', (tape_id,))
+        keep_online = c.fetchone()[0]
+        c.execute('insert into drives (name,tape_id,keep_online) values (?,?,?)',
+                  (drive_name, tape_id, keep_online))
+        c.execute('update tapes set online=1 where id=?', (tape_id,))
+        self.conn.commit()
+        return old_tape
+
+    def unmount_tape(self, drive_name, commit=True):
+        """Release the tape mounted in drive_name, and return its name
+        (or None if the drive was empty).  The tape goes offline unless
+        it was active before it was mounted, or was activated since."""
+        c = self.conn.cursor()
+        c.execute('select tape_id,keep_online from drives where name=?',
+                  (drive_name,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        tape_id, keep_online = row
+        c.execute('select name from tapes where id=?', (tape_id,))
+        tape_name = c.fetchone()[0]
+        if not keep_online:
+            c.execute('update tapes set online=0 where id=?', (tape_id,))
+        c.execute('delete from drives where name=?', (drive_name,))
+        if commit:
+            self.conn.commit()
+        return tape_name
 
     def create_tape(self, tape_name, serial, status=None, online=None):
         if status == None:
@@ -309,6 +397,7 @@ class TapeDB:
         c = self.conn.cursor()
         c.execute('update tapes set status=?,online=? where id=?',
                   ('closed', 0, tape_id))
+        c.execute('delete from drives where tape_id=?', (tape_id,))
         self.conn.commit()
 
     def get_tape_info(self, tape_name=None):
@@ -0,0 +1,303 @@
+"""
+Run archive and confirm jobs on several tape drives at once.
+
+Each drive is handled by a DriveWorker thread that performs only the
+drive operations (seeking, writing, reading back).  All database
+access happens in the thread that runs the Scheduler, so DB reads and
+writes are serialized and the sqlite connection is never shared
+between threads.
+
+A drive works only on the tape mounted in it (see TapeDB.mount_tape),
+and a tape can be mounted in only one drive, so drives never compete
+for the same backup jobs.
+"""
+
+import threading, Queue
+import time, sys
+
+
+def _print(msg):
+    print msg
+
+
+def next_file_number(db, tape_name):
+    """Return the file_number at which the next archive should be
+    written on tape_name."""
+    report = db.get_tape_report(tape_name)
+    if len(report) == 0:
+        return 0
+    return report[-1][-1]+1
+
+
+def read_tape_checksums(td, file_number, info, log=_print):
+    """Checksum the archive at file_number; the drive must already be
+    positioned there.  Returns a dict mapping filename (relative to
+    the target, as in info.files) to md5sum.  Symlinks are recorded
+    with md5sum 'symlink'."""
+    log('Checksumming %.3f GB from tape...' % (info.size_kb / 1e6))
+    CD1 = {}
+    for row in td.tape_checksums():
+        # Check prefix match; strip it off.
+        assert(row[1].startswith(info.name[1:] + '/'))
+        fname = row[1][len(info.name):]
+        CD1[fname] = row[0]
+
+    # If this archive has symlinks, then we need list the contents of
+    # the archive and record the presence of those pseudo-files.
+    n_symlinks = sum([f[2] == 'symlink' for f in info.files])
+    if n_symlinks:
+        log('Re-seeking to file_number %i...' % file_number)
+        td.goto(file_number)
+        log('Confirming %i symlinks...' % n_symlinks)
+        for fname in td.tape_files():
+            if fname.endswith('/'):
+                continue
+            # Check prefix match; strip it off.
+            assert(fname.startswith(info.name[1:] + '/'))
+            fname = fname[len(info.name):]
+            if fname not in CD1:
+                CD1[fname] = 'symlink'
+    return CD1
+
+
+def compare_checksums(info, CD1, verbose=False, log=_print):
+    """Compare checksums read from tape (as returned by
+    read_tape_checksums) to the database record in info.  Returns True
+    if everything matches."""
+    CD1 = dict(CD1)
+    ok = True
+    for name, size_kb, md5 in info.files:
+        if md5 != CD1.pop(name, None):
+            if verbose:
+                log('%s [%s]... Failed md5sum: %s' % (name, md5, name))
+            else:
+                log('Failed md5sum: %s' % name)
+            ok = False
+        elif verbose:
+            log('%s [%s]... ok' % (name, md5))
+
+    if len(CD1):
+        ok = False
+        log('Backup contained %i more files than expected!' % len(CD1))
+        log('For example:')
+        for k, v in CD1.items()[:5]:
+            log('    %s [%s]' % (k, v))
+        log('')
+    return ok
+
+
+# Drive operations run by DriveWorker.  They return (result, elapsed),
+# where elapsed excludes the initial seek.
+
+def _drive_archive(td, file_number, fpath, excluded):
+    td.goto(file_number)
+    start_time = time.time()
+    result = td.archive_remote(fpath, excluded)
+    return result, time.time() - start_time
+
+
+def _drive_confirm(td, file_number, info, log):
+    log('Seeking to file_number %i...' % file_number)
+    td.goto(file_number)
+    start_time = time.time()
+    result = read_tape_checksums(td, file_number, info, log=log)
+    return result, time.time() - start_time
+
+
+class DriveWorker(threading.Thread):
+    """
+    Thread that owns a single TapeDrive.  Requests are (func, args)
+    tuples; func is called as func(td, *args) and the outcome is put
+    on the shared results queue as (drive_name, result, exception).
+    Put None on the requests queue to stop the thread.
+    """
+    def __init__(self, drive_name, td, results):
+        threading.Thread.__init__(self, name=drive_name)
+        self.daemon = True
+        self.drive_name = drive_name
+        self.td = td
+        self.requests = Queue.Queue()
+        self.results = results
+
+    def run(self):
+        while True:
+            req = self.requests.get()
+            if req is None:
+                break
+            func, args = req
+            try:
+                self.results.put((self.drive_name, func(self.td, *args), None))
+            except Exception as e:
+                self.results.put((self.drive_name, None, e))
+
+
+class Scheduler:
+    """
+    Dispatch archive and confirm jobs to several drives concurrently.
+
+    drives is a list of (drive_name, TapeDrive) tuples.  roles maps
+    drive_name to one of VALID_ROLES; drives not listed get 'auto',
+    which archives while the mounted tape has assigned targets and
+    then confirms whatever has been recorded.
+
+    A drive stops on its first failure; the other drives carry on
+    with their own tapes.
+
+    With retry=True, confirmed jobs are checked again.  With
+    no_db_update=True, jobs are run but the database is not changed.
+    Either way, each job is run at most once per call to run().
+    """
+    VALID_ROLES = ['archive', 'confirm', 'auto']
+
+    def __init__(self, db, drives, roles=None, verbose=False,
+                 retry=False, no_db_update=False):
+        if roles is None:
+            roles = {}
+        for drive_name, role in roles.items():
+            if role not in self.VALID_ROLES:
+                raise ValueError, 'Invalid role "%s" for drive %s' % (
+                    role, drive_name)
+        self.db = db
+        self.drives = drives
+        self.roles = roles
+        self.verbose = verbose
+        self.retry = retry
+        self.no_db_update = no_db_update
+        self.results = Queue.Queue()
+        self.failed = []
+        self.done = set()
+        self.next_file_numbers = {}
+
+    def log(self, drive_name, msg):
+        print '%s [%s] %s' % (time.asctime(), drive_name, msg)
+        sys.stdout.flush()
+
+    def _next_job(self, drive_name, tape_name):
+        """Pick the next job for this drive and return a request for
+        its worker, or None if the drive has nothing left to do."""
+        role = self.roles.get(drive_name, 'auto')
+        log = lambda msg: self.log(drive_name, msg)
+        if role in ['archive', 'auto']:
+            jobs = [j for j in self.db.get_tape_work(tape_name, 'assigned')
+                    if j._id not in self.done]
+            if len(jobs):
+                job = jobs[0]
+                info = job.get_target_info()
+                # Without DB updates, the tape report does not advance.
+                file_number = max(next_file_number(self.db, tape_name),
+                                  self.next_file_numbers.get(drive_name, 0))
+                excluded = self.db.get_excluded_subdirs(info.name)
+                log('Archiving %.3f GB to %s file_number=%i (%i jobs left)' % (
+                        info.size_kb / 1e6, tape_name, file_number, len(jobs)))
+                return ('archive', job, info, file_number,
+                        (_drive_archive, (file_number, info.name, excluded)))
+        if role in ['confirm', 'auto']:
+            job_mask = ['recorded']
+            if self.retry:
+                job_mask.append('confirmed')
+            jobs = [j for j in self.db.get_tape_work(tape_name, job_mask)
+                    if j._id not in self.done]
+            if len(jobs):
+                job = jobs[0]
+                assert(job.file_number >= 0)
+                info = job.get_target_info()
+                log('Confirming %s file_number=%i (%i jobs left)' % (
+                        tape_name, job.file_number, len(jobs)))
+                return ('confirm', job, info, job.file_number,
+                        (_drive_confirm, (job.file_number, info, log)))
+        return None
+
+    def _finish_job(self, drive_name, task, result, elapsed):
+        """Record the outcome of a job in the database.  Returns True
+        on success."""
+        kind, job, info, file_number, _ = task
+        log = lambda msg: self.log(drive_name, msg)
+        self.done.add(job._id)
+        if kind == 'archive':
+            code, out, err = result
+            if code != 0:
+                log('... exit code=%i' % code)
+                log('%s %s' % (out, err))
+                return False
+            self.next_file_numbers[drive_name] = file_number + 1
+            if self.no_db_update:
+                log('Archive job succeeded, but DB will not be updated.')
+                log('If you choose to do so manually, the command is:')
+                log('update backups set file_number=%i,status=\'recorded\' '
+                    'where target_id=%i;' % (file_number, job.target_id))
+            else:
+                log('... success.  Marking record as archived.')
+                job.status = 'recorded'
+                job.file_number = file_number
+                job.commit()
+        else:
+            if not compare_checksums(info, result, self.verbose, log):
+                return False
+            if self.no_db_update:
+                log('Confirm job succeeded, but DB will not be updated.')
+            else:
+                log('Marking record as confirmed.')
+                job.status = 'confirmed'
+                job.commit()
+        log(' -- completed %.3f GB in %.1f minutes; rate is %.3f GB/min' % (
+                info.size_kb/1e6, elapsed / 60,
+                info.size_kb / max(elapsed, 1e-3) / 1e6 * 60))
+        return True
+
+    def run(self, stop_requested=None):
+        """Run jobs until every drive is out of work or has failed,
+        or until stop_requested() returns True (in which case running
+        jobs are allowed to finish).  Returns the list of drive names
+        that failed."""
+        if stop_requested is None:
+            stop_requested = lambda: False
+        workers = {}
+        tapes = {}
+        for drive_name, td in self.drives:
+            tape_id, tape_name = self.db.get_drive_tape(drive_name)
+            if tape_id is None:
+                self.log(drive_name, 'No tape mounted; skipping.')
+                continue
+            tapes[drive_name] = tape_name
+            workers[drive_name] = DriveWorker(drive_name, td, self.results)
+            workers[drive_name].start()
+
+        idle = [d for d, _ in self.drives if d in workers]
+        busy = {}
+        self.failed = []
+        while True:
+            if stop_requested():
+                idle = []
+            for drive_name in list(idle):
+                task = self._next_job(drive_name, tapes[drive_name])
+                idle.remove(drive_name)
+                if task is None:
+                    self.log(drive_name, 'No jobs found.')
+                    continue
+                busy[drive_name] = task
+                workers[drive_name].requests.put(task[-1])
+            if len(busy) == 0:
+                break
+            # Poll, so that signal handlers get a chance to run.
+            try:
+                drive_name, result, exc = self.results.get(True, 1.)
+            except Queue.Empty:
+                continue
+            task = busy.pop(drive_name)
+            if exc is not None:
+                self.log(drive_name, 'Drive operation raised %r' % exc)
+                ok = False
+            else:
+                result, elapsed = result
+                ok = self._finish_job(drive_name, task, result, elapsed)
+            if ok:
+                idle.append(drive_name)
+            else:
+                self.log(drive_name, 'Stopping this drive after failure.')
+                self.failed.append(drive_name)
+
+        for w in workers.values():
+            w.requests.put(None)
+        for w in workers.values():
+            w.join()
+        return self.failed